@@ -1,9 +1,24 @@
 import os
-from sqlalchemy.sql import func
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+import re
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import DDL, select, insert, bindparam, event, inspect, text, tuple_
+from sqlalchemy.sql import func, literal_column
+from sqlalchemy.orm import Session, object_session, selectinload, load_only, raiseload
+from sqlalchemy.engine import make_url
+from sqlalchemy.dialects.postgresql import insert as pg_insert # Also registers to_tsvector()/to_tsquery()
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from flask import Flask, abort, jsonify, render_template, request, redirect, url_for, session, flash, g
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask_compress import Compress
+from flask_caching import Cache
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 from datetime import datetime
+from jinja2 import FileSystemBytecodeCache
 import google.generativeai as genai
 import markdown # To format the AI's response nicely
 
@@ -13,11 +28,58 @@ app = Flask(__name__)
 # Database Connection
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Connection Pool (reuse Postgres connections instead of a new TLS handshake per request)
+# Sized per gunicorn worker: one connection for every thread that can query at once
+# (request threads from gunicorn.conf.py + background chat threads)
+GUNICORN_THREADS = int(os.environ.get('GUNICORN_THREADS', 8))
+CHAT_WORKERS = int(os.environ.get('CHAT_WORKERS', 4))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    "pool_pre_ping": True, # Drop dead connections before using them
+    "pool_recycle": 300,
+    "query_cache_size": 1200 # Compiled SQL cache entries per engine
+}
+database_url = make_url(app.config['SQLALCHEMY_DATABASE_URI']) if app.config['SQLALCHEMY_DATABASE_URI'] else None
+if database_url and database_url.get_backend_name() == 'postgresql':
+    # Pool sizing only applies to Postgres (a local sqlite:// DB uses a single static connection)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update({
+        "pool_size": GUNICORN_THREADS + CHAT_WORKERS,
+        "max_overflow": 10, # Short bursts above that
+        "pool_timeout": 30
+    })
+if database_url and database_url.get_driver_name() == 'psycopg2':
+    # psycopg2 fast execution helpers: batched INSERT/UPDATE instead of one statement per row
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['executemany_mode'] = 'values_plus_batch'
 app.secret_key = os.environ.get('SECRET_KEY', 'IsomoLink_Fallback_Key') # vital for sessions
 
+# Responses: gzip/brotli HTML, JSON and CSS, let browsers keep static files for a day
+app.config['COMPRESS_MIN_SIZE'] = 500
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 86400
+Compress(app)
+
+# Templates: store compiled templates on disk so new workers skip recompiling them
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+
 db = SQLAlchemy(app)
 
+# Cache (Redis when REDIS_URL is set, otherwise a per-worker in-memory cache)
+if os.environ.get('REDIS_URL'):
+    cache = Cache(app, config={'CACHE_TYPE': 'RedisCache', 'CACHE_REDIS_URL': os.environ['REDIS_URL']})
+else:
+    cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache'})
+LEADERBOARD_TTL = 300 # seconds, grade writes clear it sooner (see invalidate_leaderboard)
+LEADERBOARD_PAGE_SIZE = 50
+
+# Password Hashing (argon2id, tune the cost with `flask --app app benchmark-hash`)
+password_hasher = PasswordHasher(
+    time_cost=int(os.environ.get('ARGON2_TIME_COST', 2)),
+    memory_cost=int(os.environ.get('ARGON2_MEMORY_COST', 65536)), # KiB
+    parallelism=1
+)
+
 # --- MODELS (The Database Structure) ---
+# Trigram operators for the username search index
+event.listen(db.metadata, 'before_create', DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+
 class User(db.Model):
     __tablename__ = 'users' # Explicit table name
     id = db.Column(db.Integer, primary_key=True)
@@ -26,15 +88,37 @@ class User(db.Model):
     password_hash = db.Column(db.String(255), nullable=False)        # NEW: Secure Hash
     role = db.Column(db.String(20), default='student') # student, teacher, school
     
+    __table_args__ = (
+        # Every leaderboard/count query filters on role
+        db.Index('ix_users_role', 'role'),
+        # Trigram index (Postgres) so people search's ILIKE '%q%' doesn't scan the whole table
+        db.Index('ix_users_username_trgm', 'username', postgresql_using='gin',
+                 postgresql_ops={'username': 'gin_trgm_ops'}).ddl_if(dialect='postgresql'),
+    )
+    
     # Relationships
-    grades = db.relationship('Grade', backref='student', lazy=True)
+    grades = db.relationship('Grade', backref='student', lazy=True) # Pages that show grades selectinload them
     
     # Security Helpers
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
         
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        # Old accounts still have werkzeug pbkdf2 hashes, upgrade them on login
+        if not self.password_hash.startswith('$argon2'):
+            if not check_password_hash(self.password_hash, password):
+                return False
+            self.set_password(password)
+            return True
+        
+        try:
+            password_hasher.verify(self.password_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+        
+        if password_hasher.check_needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
 
 class Grade(db.Model):
     __tablename__ = 'grades'
@@ -43,8 +127,17 @@ class Grade(db.Model):
     subject = db.Column(db.String(50), nullable=False)
     score = db.Column(db.Float, nullable=False)
     weight = db.Column(db.Float, default=1.0)
+    
+    # Covering index: GPA + leaderboard aggregates read only the index, never the table
+    __table_args__ = (db.Index('ix_grades_student_score_weight', 'student_id', 'score', 'weight'),)
 # --- NEW MODELS (Paste this below the User class) ---
 
+# Full-Text Search (Postgres): the search route must use this exact expression to hit the GIN index
+def course_search_vector(title, description):
+    # Literals (not bound params) so the SQL text is identical to the index definition
+    document = title.concat(literal_column("' '")).concat(func.coalesce(description, literal_column("''")))
+    return func.to_tsvector(literal_column("'english'"), document)
+
 class Course(db.Model):
     __tablename__ = 'courses'
     id = db.Column(db.Integer, primary_key=True)
@@ -54,8 +147,12 @@ class Course(db.Model):
     thumbnail_url = db.Column(db.String(255)) # Image for the dashboard card
     teacher_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     
+    __table_args__ = (
+        db.Index('ix_courses_fts', course_search_vector(title, description), postgresql_using='gin').ddl_if(dialect='postgresql'),
+    )
+    
     # Relationships
-    lessons = db.relationship('Lesson', backref='course', lazy=True)
+    lessons = db.relationship('Lesson', backref='course', lazy='selectin', order_by='Lesson.position')
     # Make sure 'User' can access their courses
     teacher = db.relationship('User', backref=db.backref('courses_taught', lazy=True))
 
@@ -74,15 +171,85 @@ class ChatMessage(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     role = db.Column(db.String(10), nullable=False) # 'user' or 'model'
     content = db.Column(db.Text, nullable=False)
+    content_html = db.Column(db.Text) # Markdown rendered once at write time
+    reply_to_id = db.Column(db.Integer, db.ForeignKey('chat_message.id'), index=True) # The user message a model reply answers
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # Chat history is always "this user's messages by id", walk the index instead of the whole table
+    __table_args__ = (db.Index('ix_chat_user_id_id', 'user_id', 'id'),)
+# --- PREBUILT QUERIES ---
+# Built once at import, SQLAlchemy's compiled cache then reuses the SQL string on every request
+# Every student's Avg Score, GPA (weighted avg) and Rank (by Avg Score) in one pass over grades,
+# shared by the leaderboard and the dashboard so both rank students the same way (ties share a place)
+student_stats = select(
+    User.id,
+    User.username,
+    func.avg(Grade.score).label('avg_score'),
+    (func.sum(Grade.score * Grade.weight) / func.nullif(func.sum(Grade.weight), 0)).label('gpa'),
+    func.rank().over(order_by=func.avg(Grade.score).desc()).label('rank')
+).join(Grade).where(User.role == 'student').group_by(User.id).cte('student_stats')
+
+# Leaderboard rows, listed by (avg_score, id) so tied students keep a stable order and the pair works as a cursor
+leaderboard_columns = (student_stats.c.id, student_stats.c.username, student_stats.c.avg_score, student_stats.c.rank)
+leaderboard_order = (student_stats.c.avg_score.desc(), student_stats.c.id.desc())
+LEADERBOARD_STMT = select(*leaderboard_columns).order_by(*leaderboard_order).limit(bindparam('limit'))
+
+# Keyset page: the rows ranked after the cursor. Every page still aggregates and ranks all students
+# (the cursor filters the CTE's output, it can't be pushed below RANK()), but no OFFSET rows are sent
+LEADERBOARD_PAGE_STMT = select(*leaderboard_columns).where(
+    tuple_(student_stats.c.avg_score, student_stats.c.id) < tuple_(bindparam('after_score'), bindparam('after_id'))
+).order_by(*leaderboard_order).limit(bindparam('limit'))
+
+# One student's GPA and Rank (ranked against everyone, filtered to one row)
+STUDENT_STATS_STMT = select(student_stats.c.gpa, student_stats.c.rank).where(student_stats.c.id == bindparam('user_id'))
+
 # --- HELPER FUNCTIONS ---
-def calculate_gpa(user_id):
-    grades = Grade.query.filter_by(student_id=user_id).all()
-    if not grades: return 0.0
-    total_score = sum(g.score * g.weight for g in grades)
-    total_weight = sum(g.weight for g in grades)
-    if total_weight == 0: return 0.0
-    return round(total_score / total_weight, 1)
+@cache.memoize(timeout=LEADERBOARD_TTL)
+def top_students(limit):
+    # Top N students by Avg Score, shared by the dashboard widget and /leaderboard
+    # Core select returning plain dict rows, no ORM objects to build
+    return [dict(row) for row in db.session.execute(LEADERBOARD_STMT, {"limit": limit}).mappings()]
+
+def students_ranked_after(after_score, after_id, limit):
+    # Next leaderboard page after the (avg_score, id) of the last student shown
+    # (not cached: the cursor comes from the URL, so any client could mint new cache keys)
+    params = {"after_score": after_score, "after_id": after_id, "limit": limit}
+    return [dict(row) for row in db.session.execute(LEADERBOARD_PAGE_STMT, params).mappings()]
+
+@event.listens_for(Grade, 'after_insert')
+@event.listens_for(Grade, 'after_update')
+@event.listens_for(Grade, 'after_delete')
+def mark_leaderboard_stale(mapper, connection, target):
+    # Any grade change can reorder the rankings, clear the cache once it is committed
+    object_session(target).info['leaderboard_stale'] = True
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_leaderboard(session):
+    # Clearing at flush time would let another request re-cache the old ranking before the commit lands
+    if session.info.pop('leaderboard_stale', False):
+        cache.delete_memoized(top_students)
+
+@event.listens_for(Session, 'after_rollback')
+def forget_leaderboard_changes(session):
+    session.info.pop('leaderboard_stale', None)
+
+def recent_messages(user_id, limit):
+    # Newest N messages, put back in chronological order by the database (only the columns we send)
+    newest = select(ChatMessage.id, ChatMessage.role, ChatMessage.content, ChatMessage.content_html)\
+        .where(ChatMessage.user_id == user_id).order_by(ChatMessage.id.desc()).limit(limit).subquery()
+    return db.session.execute(
+        select(newest.c.role, newest.c.content, newest.c.content_html).order_by(newest.c.id.asc())
+    ).all()
+
+def get_current_user(*options):
+    # Loaded at most once per request, and only by routes that need the User
+    # (only the columns pages show: no password hash or email on every render)
+    # Extra loader options, e.g. selectinload(User.grades), apply to that first load
+    if 'current_user' not in g:
+        g.current_user = db.session.get(
+            User, session['user_id'], options=[load_only(User.id, User.username, User.role), *options]
+        ) if 'user_id' in session else None
+    return g.current_user
 
 # --- ROUTES ---
 
@@ -102,18 +269,21 @@ def register():
         password = request.form['password']
         role = request.form['role']
         
-        # Check if user exists
-        if User.query.filter((User.username == username) | (User.email == email)).first():
+        # Create and Save in one statement, the unique constraints decide if the user exists
+        insert_user = pg_insert if db.engine.dialect.name == 'postgresql' else sqlite_insert
+        stmt = insert_user(User).values(
+            username=username,
+            email=email,
+            password_hash=password_hasher.hash(password), # Encrypts the password
+            role=role
+        ).on_conflict_do_nothing().returning(User.id)
+        new_user_id = db.session.execute(stmt).scalar()
+        db.session.commit()
+        
+        if new_user_id is None:
             flash('Error: Username or Email is already taken!', 'danger')
             return redirect(url_for('register'))
         
-        # Create and Save
-        new_user = User(username=username, email=email, role=role)
-        new_user.set_password(password) # Encrypts the password
-        
-        db.session.add(new_user)
-        db.session.commit()
-        
         flash('Account created! Please login.', 'success')
         return redirect(url_for('login'))
         
@@ -130,6 +300,7 @@ def login():
         
         # Verify Password Hash
         if user and user.check_password(password):
+            db.session.commit() # Saves the upgraded hash, if any
             session['user_id'] = user.id
             session['username'] = user.username
             session['role'] = user.role
@@ -141,53 +312,34 @@ def login():
 
 @app.route('/dashboard')
 def dashboard():
-    if 'user_id' not in session:
+    # Students see their grades, load them together with the user
+    current_user = get_current_user(*([selectinload(User.grades)] if session.get('role') == 'student' else []))
+    if current_user is None: # Not logged in, or the account no longer exists
+        session.clear()
         return redirect(url_for('login'))
     
-    current_user = User.query.get(session['user_id'])
-    
     context = {
         "user": current_user,
         "role": current_user.role
     }
     
     if current_user.role == 'student':
-        # 1. Calculate MY GPA
-        context['gpa'] = calculate_gpa(current_user.id)
-        
-        # 2. Get MY Grades
-        context['grades'] = Grade.query.filter_by(student_id=current_user.id).all()
+        # 1. Get MY Grades (already loaded with the user)
+        context['grades'] = current_user.grades
         
-        # 3. Base Leaderboard Query (Group by User, Order by Avg Score)
-        # We define the query once so we can use it twice
-        leaderboard_query = db.session.query(
-            User.username,
-            User.id,
-            func.avg(Grade.score).label('avg_score')
-        ).join(Grade).filter(User.role == 'student').group_by(User.id).order_by(func.avg(Grade.score).desc())
-        
-        # A. Fetch Top 5 for the Widget
-        context['leaderboard'] = leaderboard_query.limit(5).all()
-
-        # B. Calculate MY RANK (The Logic Fix)
-        # We need the full list to find where YOU stand
-        all_ranked_students = leaderboard_query.all()
+        # 2. Top 5 for the Widget (cached)
+        context['leaderboard'] = top_students(5)
         
-        my_rank = 0
-        # Loop through everyone to find my position
-        for index, student in enumerate(all_ranked_students):
-            if student.id == current_user.id:
-                my_rank = index + 1 # Rank is index + 1 (because index starts at 0)
-                break
+        # 3. MY GPA and Rank (ranked against everyone in the database, only my row comes back)
+        me = db.session.execute(STUDENT_STATS_STMT, {"user_id": current_user.id}).first()
         
         # If I have no grades yet, I am unranked
-        if my_rank == 0:
-            my_rank = "--"
-            
-        context['my_rank'] = my_rank
+        context['gpa'] = round(me.gpa, 1) if me and me.gpa is not None else 0.0
+        context['my_rank'] = me.rank if me else "--"
 
     elif current_user.role == 'teacher':
-        context['total_students'] = User.query.filter_by(role='student').count()
+        # Plain COUNT(*) on the role index (Query.count() wraps the whole SELECT in a subquery)
+        context['total_students'] = db.session.query(func.count(User.id)).filter(User.role == 'student').scalar()
         # You can add revenue logic here later
     
     return render_template('dashboard.html', **context)
@@ -205,7 +357,9 @@ def logout():
 def view_course(course_id):
     if 'user_id' not in session: return redirect(url_for('login'))
     
-    course = Course.query.get_or_404(course_id)
+    # Load the lessons (ordered by position) with the course so the sidebar doesn't trigger extra queries,
+    # any other lazy load raises instead of silently adding queries
+    course = Course.query.options(selectinload(Course.lessons), raiseload('*')).get_or_404(course_id)
     # Default to the first lesson if none selected
     current_lesson = course.lessons[0] if course.lessons else None
     
@@ -216,52 +370,29 @@ def view_course(course_id):
 def watch_lesson(course_id, lesson_id):
     if 'user_id' not in session: return redirect(url_for('login'))
     
-    course = Course.query.get_or_404(course_id)
-    current_lesson = Lesson.query.get_or_404(lesson_id)
+    # One course load brings every lesson, pick the current one from it (also 404s on lessons from other courses)
+    course = Course.query.options(selectinload(Course.lessons), raiseload('*')).get_or_404(course_id)
+    current_lesson = next((lesson for lesson in course.lessons if lesson.id == lesson_id), None)
+    if current_lesson is None: abort(404)
     
     return render_template('course/player.html', course=course, current_lesson=current_lesson)
 
-# 3. Create Dummy Course (Run this once via URL to test)
-@app.route('/create-dummy-course')
-def create_dummy_course():
-    # Ensure Teacher Exists
-    teacher = User.query.filter_by(role='teacher').first()
-    if not teacher: return "Create a teacher account first!"
-
-    # Create the Course (Bundle)
-    forex_course = Course(
-        title="Intro to Forex Trading",
-        description="Master the currency markets. Learn leverage, pips, and risk management.",
-        price=5000.0,
-        teacher_id=teacher.id,
-        thumbnail_url="https://images.unsplash.com/photo-1611974765270-ca1258634369?auto=format&fit=crop&w=500&q=60"
-    )
-    db.session.add(forex_course)
-    db.session.commit()
-
-    # Add Lessons
-    lessons = [
-        Lesson(title="What is Forex?", video_url="https://www.youtube.com/embed/f432H32", duration="10:00", position=1, course=forex_course),
-        Lesson(title="Reading Candlesticks", video_url="https://www.youtube.com/embed/d3213", duration="15:30", position=2, course=forex_course),
-        Lesson(title="Risk Management Strategy", video_url="https://www.youtube.com/embed/g5435", duration="20:00", position=3, course=forex_course)
-    ]
-    db.session.add_all(lessons)
-    db.session.commit()
-    
-    return "Dummy Course 'Forex Trading' Created!"
-
 @app.route('/leaderboard')
 def leaderboard_page():
     if 'user_id' not in session: return redirect(url_for('login'))
     
-    # FETCH TOP 50 STUDENTS
-    # We removed User.full_name to fix the error
-    leaderboard_data = db.session.query(
-        User.username,
-        func.avg(Grade.score).label('avg_score')
-    ).join(Grade).filter(User.role == 'student').group_by(User.id).order_by(func.avg(Grade.score).desc()).limit(50).all()
+    # 1. First page is the cached top 50, later pages are read fresh from the ?after_score=&after_id= cursor
+    after_score = request.args.get('after_score', type=float)
+    after_id = request.args.get('after_id', type=int)
+    if after_score is None or after_id is None:
+        leaderboard_data = top_students(LEADERBOARD_PAGE_SIZE)
+    else:
+        leaderboard_data = students_ranked_after(after_score, after_id, LEADERBOARD_PAGE_SIZE)
+    
+    # 2. A full page means there may be more, the last row is the next cursor
+    next_cursor = leaderboard_data[-1] if len(leaderboard_data) == LEADERBOARD_PAGE_SIZE else None
     
-    return render_template('leaderboard.html', leaderboard=leaderboard_data)
+    return render_template('leaderboard.html', leaderboard=leaderboard_data, next_cursor=next_cursor)
 
 # --- SEARCH ROUTE ---
 @app.route('/search')
@@ -273,26 +404,65 @@ def search():
         return redirect(url_for('dashboard'))
     
     # 1. Search Courses (Title or Description)
-    # ilike makes it case-insensitive (e.g., "forex" matches "Forex")
-    courses = Course.query.filter(
-        (Course.title.ilike(f'%{query}%')) | 
-        (Course.description.ilike(f'%{query}%'))
-    ).all()
+    if db.engine.dialect.name == 'postgresql':
+        # Indexed full-text search, every word as a prefix ("fore trad" matches "Forex Trading")
+        words = re.findall(r'\w+', query)
+        prefix_query = ' & '.join(f'{word}:*' for word in words)
+        courses = Course.query.filter(
+            course_search_vector(Course.title, Course.description).op('@@')(func.to_tsquery('english', prefix_query))
+        ).all() if words else []
+    else:
+        # ilike makes it case-insensitive (e.g., "forex" matches "Forex")
+        courses = Course.query.filter(
+            (Course.title.ilike(f'%{query}%')) | 
+            (Course.description.ilike(f'%{query}%'))
+        ).all()
     
     # 2. Search People (Students & Teachers)
-    people = User.query.filter(
-        (User.username.ilike(f'%{query}%')) |
-        (User.full_name.ilike(f'%{query}%')) # Only if you added full_name column
-    ).limit(10).all()
+    people = User.query.filter(User.username.ilike(f'%{query}%')).limit(10).all()
     
     return render_template('search_results.html', query=query, courses=courses, people=people)
 # --- AI CONFIGURATION ---
-# Replace 'YOUR_API_KEY' with your actual key from Google AI Studio
-os.environ["GEMINI_API_KEY"] = "AIzaSyA_-UfBzXP1R957RjgKnX4tmJLHJsHldOUE" 
-genai.configure(api_key=os.environ["GEMINI_API_KEY"])
-
-# Set up the model
-model = genai.GenerativeModel('gemini-pro')
+# Set GEMINI_API_KEY in the environment (key from Google AI Studio), never in the code
+genai.configure(api_key=os.environ.get("GEMINI_API_KEY"))
+
+# Set up the model (the system instruction is part of the model config, not repeated in every message)
+SYSTEM_INSTRUCTION = "You are the IsomoLink AI Tutor. Keep answers concise and helpful."
+model = genai.GenerativeModel(os.environ.get('GEMINI_MODEL', 'gemini-1.5-flash'), system_instruction=SYSTEM_INSTRUCTION)
+
+CHAT_ERROR_REPLY = "I'm having trouble connecting to the brain right now."
+
+# Gemini calls run here instead of on the request thread (a reply can take seconds)
+chat_executor = ThreadPoolExecutor(max_workers=CHAT_WORKERS)
+
+# Per-worker cache of Gemini chats: user_id -> (id of the last message the chat has seen, ChatSession)
+CHAT_HISTORY_SIZE = 10 # Messages of context sent to Gemini
+CHAT_SESSION_LIMIT = 1024
+chat_sessions = OrderedDict()
+chat_sessions_lock = threading.Lock()
+
+def get_chat_session(user_id):
+    # Reuse this worker's chat if it has seen the user's latest message, otherwise
+    # (new worker, restart, or the last turn was served by another worker) rebuild it from the DB
+    last_id = db.session.query(func.max(ChatMessage.id)).filter(ChatMessage.user_id == user_id).scalar()
+    with chat_sessions_lock:
+        cached = chat_sessions.pop(user_id, None)
+    if cached and cached[0] == last_id:
+        return cached[1]
+    
+    # Map our DB roles to Gemini roles ('user' -> 'user', 'model' -> 'model')
+    history_payload = [{
+        "role": "user" if msg.role == 'user' else "model",
+        "parts": [msg.content]
+    } for msg in recent_messages(user_id, CHAT_HISTORY_SIZE)]
+    return model.start_chat(history=history_payload)
+
+def save_chat_session(user_id, last_id, chat):
+    chat.history = chat.history[-CHAT_HISTORY_SIZE:] # Keep the context window bounded
+    with chat_sessions_lock:
+        chat_sessions[user_id] = (last_id, chat)
+        if len(chat_sessions) > CHAT_SESSION_LIMIT:
+            chat_sessions.popitem(last=False) # Drop the least recently used chat
 @app.route('/school/green-hills')
 def school_profile():
     return render_template('school_profile.html')
@@ -307,52 +477,64 @@ def chat_with_tutor():
     user_text = data.get('message')
     user_id = session['user_id']
 
-    # 1. Save User Message to DB
-    new_msg = ChatMessage(user_id=user_id, role='user', content=user_text)
+    # 1. Get the Gemini chat with the Recent History (Last 10 messages) as context
+    chat = get_chat_session(user_id)
+
+    # 2. Save User Message to DB
+    new_msg = ChatMessage(user_id=user_id, role='user', content=user_text, content_html=markdown.markdown(user_text))
     db.session.add(new_msg)
+    if db.engine.dialect.name == 'postgresql':
+        # Don't make the request wait for the WAL flush (a crash could lose this one chat line, nothing else)
+        db.session.execute(text('SET LOCAL synchronous_commit TO OFF'))
     db.session.commit()
+
+    # 3. Ask Gemini in the background, the browser polls /api/chat/result/<job_id> for the reply
+    chat_executor.submit(generate_reply, new_msg.id, user_id, user_text, chat)
+    return jsonify({"job_id": new_msg.id}), 202
+
+def generate_reply(job_id, user_id, user_text, chat):
+    # Runs on a chat_executor thread, with its own app context and DB session
+    with app.app_context():
+        try:
+            # Send the new message
+            response = chat.send_message(user_text)
+            ai_text = response.text
+        except Exception as e:
+            print(f"AI Error: {e}")
+            # Saved as the reply like any other, so a poll on any worker sees it
+            ai_text = CHAT_ERROR_REPLY
+            chat = None
+        
+        # 4. Save AI Response to DB, linked to the message it answers
+        # (Converted to HTML once here, for display now and in the history later)
+        try:
+            ai_msg = ChatMessage(user_id=user_id, role='model', content=ai_text, content_html=markdown.markdown(ai_text), reply_to_id=job_id)
+            db.session.add(ai_msg)
+            db.session.flush()
+            if chat is not None:
+                # Cached before the commit, so the next turn (sent once the poll sees this reply) finds it
+                save_chat_session(user_id, ai_msg.id, chat)
+            db.session.commit()
+        except Exception:
+            # Nothing waits on this thread's result, so log it here (the widget gives up polling after 60s)
+            app.logger.exception("Failed to save chat reply to message %s", job_id)
+            db.session.rollback()
+            with chat_sessions_lock:
+                chat_sessions.pop(user_id, None) # Its history has a turn the DB doesn't
+
+@app.route('/api/chat/result/<int:job_id>', methods=['GET'])
+def get_chat_result(job_id):
+    if 'user_id' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
     
-    # 2. Fetch Recent History (Last 10 messages) to give context
-    # We order by ID desc to get newest, then reverse back to chronological order
-    recent_history = ChatMessage.query.filter_by(user_id=user_id)\
-        .order_by(ChatMessage.id.desc()).limit(10).all()
-    recent_history.reverse()
-
-    # 3. Build Prompt for Gemini
-    chat_session = model.start_chat(history=[])
+    # The reply (or the error reply) saved for this message, by whichever worker generated it
+    reply_html = db.session.query(ChatMessage.content_html).filter(
+        ChatMessage.user_id == session['user_id'], ChatMessage.reply_to_id == job_id
+    ).scalar()
     
-    # Pre-load the history into Gemini object
-    history_payload = []
-    for msg in recent_history:
-        # Map our DB roles to Gemini roles ('user' -> 'user', 'model' -> 'model')
-        history_payload.append({
-            "role": "user" if msg.role == 'user' else "model",
-            "parts": [msg.content]
-        })
-
-    # System instruction (Gemini Pro treats this as the first prompt often, or we wrap it)
-    system_instruction = "You are the IsomoLink AI Tutor. Keep answers concise and helpful."
-
-    try:
-        # Create a chat object with history
-        chat = model.start_chat(history=history_payload)
-        
-        # Send the new message
-        response = chat.send_message(user_text + f"\n\n(System Note: {system_instruction})")
-        ai_text = response.text
-        
-        # 4. Save AI Response to DB
-        ai_msg = ChatMessage(user_id=user_id, role='model', content=ai_text)
-        db.session.add(ai_msg)
-        db.session.commit()
-        
-        # Convert to HTML for display
-        html_response = markdown.markdown(ai_text)
-        return jsonify({"response": html_response})
-        
-    except Exception as e:
-        print(f"AI Error: {e}")
-        return jsonify({"response": "I'm having trouble connecting to the brain right now."})
+    if reply_html is not None:
+        return jsonify({"status": "done", "response": reply_html})
+    return jsonify({"status": "pending"})
 
 # --- NEW ROUTE: LOAD HISTORY ---
 @app.route('/api/chat/history', methods=['GET'])
@@ -360,19 +542,85 @@ def get_chat_history():
     if 'user_id' not in session: return jsonify([])
     
     # Get last 20 messages
-    history = ChatMessage.query.filter_by(user_id=session['user_id'])\
-        .order_by(ChatMessage.id.asc()).limit(20).all()
+    history = recent_messages(session['user_id'], 20)
     
     return jsonify([{
         "role": msg.role,
-        "content": markdown.markdown(msg.content) # Pre-format markdown for frontend
+        "content": msg.content_html or markdown.markdown(msg.content) # Older rows may not be backfilled yet
     } for msg in history])
 
-# --- DB INIT (Run Once) ---
-@app.route('/init-db')
+# --- DB INIT (Run Once at deploy: flask --app app init-db) ---
+@app.cli.command('init-db')
 def init_db():
     db.create_all()
-    return "Database Tables Re-Created Successfully!"
+    print("Database Tables Created Successfully!")
+
+# --- DUMMY DATA (flask --app app seed-dummy-course) ---
+@app.cli.command('seed-dummy-course')
+def seed_dummy_course():
+    # Ensure Teacher Exists
+    teacher = User.query.filter_by(role='teacher').first()
+    if not teacher:
+        print("Create a teacher account first!")
+        return
+
+    # Create the Course (Bundle)
+    forex_course = Course(
+        title="Intro to Forex Trading",
+        description="Master the currency markets. Learn leverage, pips, and risk management.",
+        price=5000.0,
+        teacher_id=teacher.id,
+        thumbnail_url="https://images.unsplash.com/photo-1611974765270-ca1258634369?auto=format&fit=crop&w=500&q=60"
+    )
+    db.session.add(forex_course)
+    db.session.flush() # Assigns forex_course.id for the lessons
+
+    # Add Lessons (one bulk INSERT, same transaction as the course)
+    lessons = [
+        {"title": "What is Forex?", "video_url": "https://www.youtube.com/embed/f432H32", "duration": "10:00", "position": 1},
+        {"title": "Reading Candlesticks", "video_url": "https://www.youtube.com/embed/d3213", "duration": "15:30", "position": 2},
+        {"title": "Risk Management Strategy", "video_url": "https://www.youtube.com/embed/g5435", "duration": "20:00", "position": 3}
+    ]
+    db.session.execute(insert(Lesson), [dict(lesson, course_id=forex_course.id) for lesson in lessons])
+    db.session.commit()
+    
+    print("Dummy Course 'Forex Trading' Created!")
+
+# --- ONE-TIME MIGRATION: pre-rendered chat HTML and reply links (flask --app app migrate-chat-html) ---
+@app.cli.command('migrate-chat-html')
+def migrate_chat_html():
+    columns = [column['name'] for column in inspect(db.engine).get_columns(ChatMessage.__tablename__)]
+    if 'content_html' not in columns:
+        db.session.execute(text(f'ALTER TABLE {ChatMessage.__tablename__} ADD COLUMN content_html TEXT'))
+        db.session.commit()
+    if 'reply_to_id' not in columns:
+        db.session.execute(text(
+            f'ALTER TABLE {ChatMessage.__tablename__} ADD COLUMN reply_to_id INTEGER REFERENCES {ChatMessage.__tablename__} (id)'
+        ))
+        db.session.commit()
+    for index in ChatMessage.__table__.indexes:
+        index.create(db.engine, checkfirst=True) # Adds ix_chat_message_reply_to_id, skips the ones already there
+    
+    # Backfill in batches so a long history doesn't sit in memory at once
+    total = 0
+    while True:
+        batch = ChatMessage.query.filter(ChatMessage.content_html.is_(None)).limit(500).all()
+        if not batch: break
+        for msg in batch:
+            msg.content_html = markdown.markdown(msg.content)
+        db.session.commit()
+        total += len(batch)
+    print(f"Rendered {total} chat messages.")
+
+# --- PASSWORD COST BENCHMARK (pick ARGON2_TIME_COST for ~250ms per hash) ---
+@app.cli.command('benchmark-hash')
+def benchmark_hash():
+    for time_cost in range(1, 7):
+        hasher = PasswordHasher(time_cost=time_cost, memory_cost=password_hasher.memory_cost, parallelism=1)
+        start = time.perf_counter()
+        hasher.hash("benchmark-password")
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        print(f"time_cost={time_cost} memory_cost={hasher.memory_cost}KiB: {elapsed_ms:.0f}ms")
 
 if __name__ == '__main__':
     app.run(debug=True)
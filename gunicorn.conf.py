@@ -0,0 +1,15 @@
+# --- GUNICORN CONFIGURATION ---
+# Picked up automatically by `gunicorn app:app` (Render start command)
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '10000')}"
+
+# Threaded workers: while one request waits on Postgres or Gemini,
+# the other threads in the same worker keep serving pages
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# Gemini replies can take a while, don't kill the worker mid-answer
+timeout = 60
+keepalive = 5